@@ -1,31 +1,51 @@
+# Production: gunicorn -k gevent -w 4 --worker-connections 200 --preload --bind 0.0.0.0:5002 app:app
+# --preload runs the startup block once, in the gunicorn master. The master then holds
+# no connections and no threads; each worker starts its own cleanup_loop on first request.
+# The /articles cache is per worker, so other workers may lag a write by up to
+# ARTICLES_CACHE_TTL_SECONDS; cart_add always re-checks stock in its transaction.
 import os
 import threading
 import time
-from datetime import datetime, timedelta, timezone
-from flask import Flask, jsonify, request
+from flask import Flask, g, request
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import and_, delete, event, func, inspect, lambda_stmt, select, text, update
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import QueuePool
+import orjson
 # Avoid external flask_cors dependency to keep runtime simple.
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "pos_stock.db")
 RESERVATION_TTL_SECONDS = 600
+RESERVATION_RETENTION_SECONDS = 86400
+CLEANUP_INTERVAL_SECONDS = 30
+CLEANUP_MAX_INTERVAL_SECONDS = 300  # keep <= RESERVATION_TTL_SECONDS: a hold made mid-sleep must not lapse first
 SEED_ON_START = True
+WRITE_BEGIN_RETRIES = 3
+ARTICLES_CACHE_TTL_SECONDS = 5
 
 app = Flask(__name__)
 # Restrict allowed origin to the frontend host and ensure preflight OPTIONS
 # requests are handled correctly. Do not use '*' with credentials enabled.
 ALLOWED_ORIGINS = ["http://127.0.0.1:8000", "http://localhost:8000"]
+# Response headers per allowed origin, built once instead of on every response.
+_CORS = {
+    o: {
+        "Access-Control-Allow-Origin": o,
+        "Access-Control-Allow-Credentials": "true",
+        "Access-Control-Allow-Headers": "Content-Type, Authorization",
+        "Access-Control-Allow-Methods": "GET, POST, DELETE, OPTIONS",
+        "Vary": "Origin",
+    }
+    for o in ALLOWED_ORIGINS
+}
 
 def _add_cors_headers(resp):
-    origin = request.headers.get("Origin")
-    if origin and origin in ALLOWED_ORIGINS:
-        resp.headers["Access-Control-Allow-Origin"] = origin
-        resp.headers["Access-Control-Allow-Credentials"] = "true"
-        resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-        resp.headers["Access-Control-Allow-Methods"] = "GET, POST, DELETE, OPTIONS"
-        resp.headers["Vary"] = "Origin"
+    h = _CORS.get(request.headers.get("Origin"))
+    if h:
+        resp.headers.update(h)
     return resp
 
 
@@ -44,6 +64,15 @@ def handle_options():
 
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Reuse connections across requests so the connect-time PRAGMAs and page cache persist.
+# Driver autocommit: transactions are opened by begin_sqlite_transaction below.
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool,
+    "pool_size": 8,
+    "max_overflow": 4,
+    "pool_recycle": 3600,
+    "connect_args": {"check_same_thread": False, "timeout": 5, "isolation_level": None},
+}
 db = SQLAlchemy(app)
 
 class Article(db.Model):
@@ -53,53 +82,148 @@ class Article(db.Model):
     name = db.Column(db.String(200), nullable=False)
     price = db.Column(db.Float, nullable=False)
     quantity = db.Column(db.Integer, nullable=False, default=0)
+    # sum of active reservations, maintained by RESERVATION_TRIGGERS
+    reserved_qty = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
-    def to_dict(self, include_reserved=False):
-        reserved = compute_reserved_for_article(self.id) if include_reserved else 0
+    def to_dict(self):
         return {
             "id": self.id,
             "sku": self.sku,
             "name": self.name,
             "price": self.price,
             "quantity": self.quantity,
-            "reserved_qty": reserved
+            "reserved_qty": self.reserved_qty
         }
 
 class Reservation(db.Model):
     __tablename__ = "reservations"
     id = db.Column(db.Integer, primary_key=True)
-    cart_id = db.Column(db.String(64), nullable=False, index=True)
+    cart_id = db.Column(db.String(64), nullable=False)
     article_id = db.Column(db.Integer, db.ForeignKey("articles.id"), nullable=False)
     qty = db.Column(db.Integer, nullable=False)
     active = db.Column(db.Integer, nullable=False, default=1)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=func.now(), server_default=func.now())
+    expires_at = db.Column(db.Integer, nullable=False)  # UNIX epoch seconds
     article = db.relationship("Article")
+    __table_args__ = (
+        db.Index("ix_res_active_exp", "active", "expires_at"),
+        db.Index("ix_res_cart_active", "cart_id", "active"),
+        db.Index("ix_res_article_active_exp", "article_id", "active", "expires_at"),
+    )
 
-def now_utc():
-    return datetime.now(timezone.utc)
+def ojson(obj, status=200):
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
 
-def compute_reserved_for_article(article_id):
-    total = db.session.query(func.sum(Reservation.qty)).filter(
-        Reservation.article_id == article_id,
-        Reservation.active == 1,
-        Reservation.expires_at > now_utc()
-    ).scalar()
-    return int(total or 0)
+def now_ts():
+    return int(time.time())
+
+RESERVATION_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS trg_res_reserve AFTER INSERT ON reservations
+    WHEN NEW.active = 1 BEGIN
+        UPDATE articles SET reserved_qty = reserved_qty + NEW.qty WHERE id = NEW.article_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_res_release AFTER UPDATE OF active ON reservations
+    WHEN OLD.active = 1 AND NEW.active = 0 BEGIN
+        UPDATE articles SET reserved_qty = reserved_qty - OLD.qty WHERE id = OLD.article_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_res_delete AFTER DELETE ON reservations
+    WHEN OLD.active = 1 BEGIN
+        UPDATE articles SET reserved_qty = reserved_qty - OLD.qty WHERE id = OLD.article_id;
+    END""",
+)
+
+def convert_expires_to_epoch():
+    # one-shot migration: rows written before expires_at became an integer hold ISO text (UTC)
+    db.session.execute(text(
+        "UPDATE reservations SET expires_at = CAST(strftime('%s', expires_at) AS INTEGER) "
+        "WHERE typeof(expires_at) = 'text'"
+    ))
+    db.session.commit()
+
+def install_reserved_counter():
+    if "reserved_qty" not in {c["name"] for c in inspect(db.engine).get_columns("articles")}:
+        db.session.execute(text("ALTER TABLE articles ADD COLUMN reserved_qty INTEGER NOT NULL DEFAULT 0"))
+    for ddl in RESERVATION_TRIGGERS:
+        db.session.execute(text(ddl))
+    # resync from the live rows in case they were edited outside the app
+    db.session.execute(
+        update(Article).values(
+            reserved_qty=db.session.query(func.coalesce(func.sum(Reservation.qty), 0)).filter(
+                Reservation.article_id == Article.id, Reservation.active == 1
+            ).scalar_subquery()
+        ).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+def begin_write():
+    # must run before the request's first query; retried if busy_timeout runs out
+    for attempt in range(WRITE_BEGIN_RETRIES):
+        try:
+            db.session.connection(execution_options={"sqlite_immediate": True})
+            return
+        except OperationalError:
+            db.session.rollback()
+            if attempt == WRITE_BEGIN_RETRIES - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+# Serialized /articles body, dropped by every endpoint that changes stock or reservations.
+# The generation counter stops a slow reader from storing a body computed before a write.
+_articles_cache = {"body": None, "expires": 0.0, "generation": 0}
+_articles_cache_lock = threading.Lock()
+
+def invalidate_articles_cache():
+    with _articles_cache_lock:
+        _articles_cache["body"] = None
+        _articles_cache["generation"] += 1
+
+def expire_reservations(now):
+    return db.session.execute(
+        update(Reservation)
+        .where(Reservation.active == 1, Reservation.expires_at <= now)
+        .values(active=0)
+        .execution_options(synchronize_session=False)
+    ).rowcount
 
 def cleanup_loop():
+    # writers expire reservations themselves, so an idle pass backs off instead of
+    # committing (and checkpointing the WAL) every CLEANUP_INTERVAL_SECONDS
+    idle_passes = 0
     while True:
         with app.app_context():
-            expired = Reservation.query.filter(
-                Reservation.active == 1,
-                Reservation.expires_at <= now_utc()
-            ).all()
-            for r in expired:
-                r.active = 0
-            db.session.commit()
-        time.sleep(30)
-
-threading.Thread(target=cleanup_loop, daemon=True).start()
+            try:
+                now = now_ts()
+                expired = expire_reservations(now)
+                # drop long-closed rows so the table and its indexes stay sized to live carts
+                purged = db.session.execute(
+                    delete(Reservation)
+                    .where(
+                        Reservation.active == 0,
+                        Reservation.expires_at < now - RESERVATION_RETENTION_SECONDS
+                    )
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+                if expired or purged:
+                    db.session.commit()
+                else:
+                    db.session.rollback()
+                if expired:
+                    invalidate_articles_cache()
+                next_expiry = db.session.query(func.min(Reservation.expires_at)).filter(
+                    Reservation.active == 1
+                ).scalar()
+            except SQLAlchemyError:
+                # e.g. "database is locked" past busy_timeout; the thread must survive it
+                db.session.rollback()
+                app.logger.exception("reservation cleanup pass failed, retrying")
+                time.sleep(CLEANUP_INTERVAL_SECONDS)
+                continue
+        idle_passes = 0 if expired or purged else min(idle_passes + 1, 4)
+        delay = min(CLEANUP_MAX_INTERVAL_SECONDS, CLEANUP_INTERVAL_SECONDS * 2 ** idle_passes)
+        if next_expiry is not None:
+            # reserved_qty counts a hold until it is flipped, so wake when the earliest one lapses
+            delay = min(delay, max(1, next_expiry - now_ts()))
+        time.sleep(delay)
 
 def seed_sample():
     if Article.query.count() == 0:
@@ -113,41 +237,113 @@ def seed_sample():
         db.session.commit()
 
 with app.app_context():
+    # WAL lets /articles and /cart reads proceed while cleanup_loop or a checkout writes
+    @event.listens_for(db.engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA cache_size=-20000")
+        # read index pages straight from the OS page cache instead of copying into the pager
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    @event.listens_for(db.engine, "begin")
+    def begin_sqlite_transaction(conn):
+        # writers take the write lock up front instead of upgrading a read transaction
+        if conn.get_execution_options().get("sqlite_immediate"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
+
     db.create_all()
+    # create_all() skips existing tables, so add indexes declared after they were created
+    for index in Reservation.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    # superseded by ix_res_cart_active; older databases still carry it
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_reservations_cart_id"))
+    convert_expires_to_epoch()
+    install_reserved_counter()
     if SEED_ON_START:
         seed_sample()
+    db.session.remove()
+    # don't hand the startup connections to forked gunicorn workers
+    db.engine.dispose()
+
+_cleanup_pid = None
+_cleanup_start_lock = threading.Lock()
+
+@app.before_request
+def ensure_cleanup_thread():
+    # started lazily rather than at import: a thread or pooled connection must not cross fork()
+    global _cleanup_pid
+    if _cleanup_pid == os.getpid():
+        return
+    with _cleanup_start_lock:
+        if _cleanup_pid != os.getpid():
+            _cleanup_pid = os.getpid()
+            threading.Thread(target=cleanup_loop, daemon=True).start()
+
+@app.before_request
+def stamp_request_time():
+    # one clock read per request, shared by every statement the handler runs
+    g.now = now_ts()
 
 @app.route("/articles", methods=["GET"])
 def get_articles():
-    return jsonify([a.to_dict(include_reserved=True) for a in Article.query.all()])
+    with _articles_cache_lock:
+        generation = _articles_cache["generation"]
+        if _articles_cache["body"] is not None and _articles_cache["expires"] > time.monotonic():
+            return app.response_class(_articles_cache["body"], mimetype="application/json")
+    body = orjson.dumps([a.to_dict() for a in Article.query.all()])
+    with _articles_cache_lock:
+        if _articles_cache["generation"] == generation:
+            _articles_cache["body"] = body
+            _articles_cache["expires"] = time.monotonic() + ARTICLES_CACHE_TTL_SECONDS
+    return app.response_class(body, mimetype="application/json")
 
 @app.route("/cart/add", methods=["POST"])
 def cart_add():
-    data = request.get_json() or {}
-    cart_id = str(data.get("cart_id"))
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return ojson({"error": "bad_params"}, 400)
+    cart_id = data.get("cart_id")
     article_id = data.get("article_id")
-    qty = int(data.get("qty", 1))
-    if not article_id or not cart_id:
-        return jsonify({"error": "missing_params"}), 400
-    article = Article.query.get(article_id)
+    qty = data.get("qty", 1)
+    # the frontend sends numeric cart ids; bool is an int subclass, so reject it explicitly
+    if (type(cart_id) not in (str, int) or cart_id == "" or type(article_id) is not int
+            or type(qty) is not int or qty <= 0):
+        return ojson({"error": "bad_params"}, 400)
+    cart_id = str(cart_id)
+    begin_write()
+    now = g.now
+    # release lapsed holds first so reserved_qty is current for the stock check
+    expire_reservations(now)
+    article = db.session.get(Article, article_id)
     if not article:
-        return jsonify({"error": "not_found"}), 404
-    reserved = compute_reserved_for_article(article_id)
-    if qty > article.quantity - reserved:
-        return jsonify({"error": "stock_insufficient"}), 409
-    expires = now_utc() + timedelta(seconds=RESERVATION_TTL_SECONDS)
+        return ojson({"error": "not_found"}, 404)
+    if qty > article.quantity - article.reserved_qty:
+        return ojson({"error": "stock_insufficient"}, 409)
+    expires = now + RESERVATION_TTL_SECONDS
     r = Reservation(cart_id=cart_id, article_id=article_id, qty=qty, active=1, expires_at=expires)
     db.session.add(r)
     db.session.commit()
-    return jsonify({"result": "reserved", "reservation_id": r.id}), 201
+    invalidate_articles_cache()
+    return ojson({"result": "reserved", "reservation_id": r.id}, 201)
 
 @app.route("/cart/<cart_id>", methods=["GET"])
 def get_cart(cart_id):
-    res = Reservation.query.filter(
-        Reservation.cart_id == str(cart_id),
+    cart_id, now = str(cart_id), g.now
+    # lambda_stmt caches the constructed statement; only cart_id and now are re-bound per call
+    stmt = lambda_stmt(lambda: select(Reservation).options(joinedload(Reservation.article)).where(
+        Reservation.cart_id == cart_id,
         Reservation.active == 1,
-        Reservation.expires_at > now_utc()
-    ).all()
+        Reservation.expires_at > now
+    ))
+    res = db.session.execute(stmt).scalars().all()
     items = [{
         "reservation_id": r.id,
         "article_id": r.article_id,
@@ -155,31 +351,43 @@ def get_cart(cart_id):
         "price": r.article.price,
         "qty": r.qty
     } for r in res]
-    return jsonify({"items": items})
+    return ojson({"items": items})
 
 @app.route("/cart/remove/<int:res_id>", methods=["DELETE", "OPTIONS"])
 def remove_item(res_id):
-    r = Reservation.query.get(res_id)
+    begin_write()
+    r = db.session.get(Reservation, res_id)
     if not r:
-        return jsonify({"error": "not_found"}), 404
+        return ojson({"error": "not_found"}, 404)
     r.active = 0
     db.session.commit()
-    return jsonify({"result": "released"}), 200
+    invalidate_articles_cache()
+    return ojson({"result": "released"}, 200)
 
 @app.route("/checkout/<cart_id>", methods=["POST"])
 def checkout(cart_id):
-    res = Reservation.query.filter(
-        Reservation.cart_id == str(cart_id),
-        Reservation.active == 1
-    ).all()
-    if not res:
-        return jsonify({"error": "empty"}), 400
-    for r in res:
-        art = Article.query.get(r.article_id)
-        art.quantity -= r.qty
-        r.active = 0
+    begin_write()
+    expire_reservations(g.now)
+    live = and_(Reservation.cart_id == str(cart_id), Reservation.active == 1)
+    # one UPDATE debits every article by its reserved quantity, one closes the reservations
+    cart_qty = db.session.query(func.coalesce(func.sum(Reservation.qty), 0)).filter(
+        Reservation.article_id == Article.id, live
+    ).scalar_subquery()
+    debited = db.session.execute(
+        update(Article)
+        .where(Article.id.in_(db.session.query(Reservation.article_id).filter(live)))
+        .values(quantity=Article.quantity - cart_qty)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not debited:
+        return ojson({"error": "empty"}, 400)
+    db.session.execute(
+        update(Reservation).where(live).values(active=0).execution_options(synchronize_session=False)
+    )
     db.session.commit()
-    return jsonify({"result": "checkout_success"}), 200
+    invalidate_articles_cache()
+    return ojson({"result": "checkout_success"}, 200)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5002, debug=True)
+    # development only; see the gunicorn command at the top of this file
+    app.run(host="0.0.0.0", port=5002, threaded=True)
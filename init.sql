@@ -39,6 +39,7 @@ CREATE TABLE IF NOT EXISTS cart_items (
     FOREIGN KEY(cart_id) REFERENCES carts(id) ON DELETE CASCADE,
     FOREIGN KEY(article_id) REFERENCES articles(id)
 );
+CREATE INDEX IF NOT EXISTS ix_cartitem_cart_article ON cart_items(cart_id, article_id);
 
 CREATE TABLE IF NOT EXISTS invoices (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
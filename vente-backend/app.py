@@ -1,26 +1,64 @@
 # app.py - Vente en Magasin (Flask + SQLAlchemy)
 from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, case, cast, event, func, update
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import QueuePool
 import os
 import random
 import json
+import orjson
 
 # Config
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///pos_vente.db')
 TAX_RATE = Decimal(os.getenv('TAX_RATE', '0.19'))  # 19% by default
 REMISE_MANAGER_THRESHOLD_PERCENT = Decimal(os.getenv('REMISE_MANAGER_THRESHOLD_PERCENT', '0.10'))  # 10%
 REMISE_MANAGER_THRESHOLD_AMOUNT = Decimal(os.getenv('REMISE_MANAGER_THRESHOLD_AMOUNT', '50.0'))
+INVOICE_PAGE_SIZE = int(os.getenv('INVOICE_PAGE_SIZE', '100'))
+SQLITE_FILE_DB = DATABASE_URL.startswith('sqlite') and ':memory:' not in DATABASE_URL
 
 app = Flask(__name__)
 from flask_cors import CORS
 CORS(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if SQLITE_FILE_DB:
+    # pooled connections may be handed to any request thread; the driver runs in
+    # autocommit mode and transactions are opened by begin_sqlite_transaction()
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': QueuePool,
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': False,
+        'query_cache_size': 1200,
+        'connect_args': {'check_same_thread': False, 'isolation_level': None},
+    }
 
 db = SQLAlchemy(app)
 
+# SQLite tuning: WAL lets readers proceed while a writer holds the lock
+if SQLITE_FILE_DB:
+    with app.app_context():
+        @event.listens_for(db.engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA busy_timeout=30000")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.execute("PRAGMA cache_size=-65536")
+            cursor.close()
+
+        @event.listens_for(db.engine, 'begin')
+        def begin_sqlite_transaction(conn):
+            # writers take the write lock up front instead of upgrading a read transaction
+            if conn.get_execution_options().get('sqlite_immediate'):
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            else:
+                conn.exec_driver_sql("BEGIN")
+
 # ---------- Models ----------
 class Setting(db.Model):
     __tablename__ = 'settings'
@@ -41,8 +79,8 @@ class Cart(db.Model):
     __tablename__ = 'carts'
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.String(30), nullable=False, default='OPEN')  # OPEN, CHECKOUT_PENDING, PAID, CANCELLED
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=func.now(), server_default=func.now())
+    updated_at = db.Column(db.DateTime, nullable=False, default=func.now(), server_default=func.now(), onupdate=func.now())
 
 class CartItem(db.Model):
     __tablename__ = 'cart_items'
@@ -53,6 +91,7 @@ class CartItem(db.Model):
     unit_price = db.Column(db.Numeric(12,2), nullable=False)
     discount = db.Column(db.Numeric(12,2), nullable=False, default=0.0)
     article = db.relationship('Article')
+    __table_args__ = (db.Index('ix_cartitem_cart_article', 'cart_id', 'article_id'),)
 
 class Invoice(db.Model):
     __tablename__ = 'invoices'
@@ -63,7 +102,7 @@ class Invoice(db.Model):
     total_ttc = db.Column(db.Numeric(12,2), nullable=False)
     payment_method = db.Column(db.String(50))
     payment_status = db.Column(db.String(30), default='PENDING')  # PENDING, AUTHORIZED, FAILED
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=func.now(), server_default=func.now())
 
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
@@ -71,7 +110,7 @@ class AuditLog(db.Model):
     event = db.Column(db.String(200), nullable=False)
     payload = db.Column(db.Text)
     actor = db.Column(db.String(100))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=func.now(), server_default=func.now())
 
 # ---------- Helpers ----------
 def decimal(v):
@@ -88,12 +127,34 @@ def row_article(a: Article):
         "vat": float(a.vat)
     }
 
+def row_invoice(i: Invoice):
+    return {
+        "id": i.id,
+        "cart_id": i.cart_id,
+        "total_ht": float(i.total_ht),
+        "total_tax": float(i.total_tax),
+        "total_ttc": float(i.total_ttc),
+        "payment_method": i.payment_method,
+        "payment_status": i.payment_status,
+        "created_at": i.created_at
+    }
+
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC
+
+def ojsonify(obj, status=200):
+    # orjson encodes datetimes natively and is much faster than stdlib json on large lists
+    return Response(orjson.dumps(obj, option=ORJSON_OPTIONS), status=status, mimetype='application/json')
+
+def begin_write():
+    # must run before the request's first query so the transaction opens as BEGIN IMMEDIATE
+    db.session.connection(execution_options={'sqlite_immediate': True})
+
 def log_event(event, payload=None, actor=None):
+    # committed together with the caller's changes
     db.session.add(AuditLog(event=event, payload=json.dumps(payload, default=str) if payload else None, actor=actor))
-    db.session.commit()
 
 def get_setting(key, default=None):
-    s = Setting.query.get(key)
+    s = db.session.get(Setting, key)
     return s.value if s else default
 
 # ---------- Init / Seed ----------
@@ -115,6 +176,11 @@ def seed_defaults():
             db.session.add(Article(sku=s['sku'], name=s['name'], price=s['price'], stock=s['stock'], reserved=0, vat=TAX_RATE))
     db.session.commit()
 
+def ensure_indexes():
+    # create_all() skips existing tables, so add indexes declared after they were created
+    for index in CartItem.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
 # ---------- Endpoints ----------
 @app.route('/health', methods=['GET'])
 def health():
@@ -123,29 +189,31 @@ def health():
 @app.route('/articles', methods=['GET'])
 def list_articles():
     articles = Article.query.all()
-    return jsonify({"articles":[row_article(a) for a in articles]})
+    return ojsonify({"articles":[row_article(a) for a in articles]})
 
 @app.route('/articles/<int:article_id>', methods=['GET'])
 def get_article(article_id):
-    a = Article.query.get(article_id)
+    a = db.session.get(Article, article_id)
     if not a:
         abort(404, "Article not found")
     return jsonify(row_article(a))
 
 @app.route('/panier', methods=['POST'])
 def create_cart():
+    begin_write()
     c = Cart(status='OPEN')
     db.session.add(c)
-    db.session.commit()
+    db.session.flush()
     log_event("cart_created", {"cart_id": c.id}, actor=request.remote_addr)
+    db.session.commit()
     return jsonify({"cart_id": c.id}), 201
 
 @app.route('/panier/<int:cart_id>', methods=['GET'])
 def view_cart(cart_id):
-    c = Cart.query.get(cart_id)
+    c = db.session.get(Cart, cart_id)
     if not c:
         abort(404, "Cart not found")
-    items = CartItem.query.filter_by(cart_id=cart_id).all()
+    items = CartItem.query.options(selectinload(CartItem.article)).filter_by(cart_id=cart_id).all()
     items_out = []
     for it in items:
         items_out.append({
@@ -167,66 +235,82 @@ def add_item(cart_id):
     discount = Decimal(str(data.get("discount", "0.0")))
     if not article_id or qty <= 0:
         abort(400, "article_id and qty>0 required")
-    c = Cart.query.get(cart_id)
+    begin_write()
+    c = db.session.get(Cart, cart_id)
     if not c or c.status != 'OPEN':
         abort(400, "Cart not found or not open")
-    a = Article.query.get(article_id)
+    a = db.session.get(Article, article_id)
     if not a:
         abort(404, "Article not found")
-    available = a.stock - a.reserved
-    if qty > available:
-        abort(400, f"Stock insuffisant. disponible={available}")
     # check existing item
     existing = CartItem.query.filter_by(cart_id=cart_id, article_id=article_id).first()
+    needed = existing.qty + qty if existing else qty
+    # reserve: the conditional UPDATE only matches while enough stock is free
+    reserve = update(Article).where(Article.id == article_id, Article.stock - Article.reserved >= needed).values(
+        reserved=Article.reserved + qty).execution_options(synchronize_session=False)
+    if db.session.execute(reserve).rowcount == 0:
+        available = a.stock - a.reserved
+        if qty > available:
+            abort(400, f"Stock insuffisant. disponible={available}")
+        abort(400, "Stock insuffisant pour la quantité totale demandée")
     if existing:
-        if existing.qty + qty > (a.stock - a.reserved):
-            abort(400, "Stock insuffisant pour la quantité totale demandée")
         existing.qty = existing.qty + qty
         existing.discount = existing.discount + discount
     else:
         ci = CartItem(cart_id=cart_id, article_id=article_id, qty=qty, unit_price=a.price, discount=discount)
         db.session.add(ci)
-    # reserve
-    a.reserved = a.reserved + qty
-    db.session.commit()
     log_event("item_added_to_cart", {"cart_id": cart_id, "article_id": article_id, "qty": qty}, actor=request.remote_addr)
+    db.session.commit()
     return jsonify({"message":"item_added"}), 201
 
 @app.route('/panier/<int:cart_id>/items/<int:article_id>', methods=['DELETE'])
 def remove_item(cart_id, article_id):
-    c = Cart.query.get(cart_id)
+    begin_write()
+    c = db.session.get(Cart, cart_id)
     if not c:
         abort(404, "Cart not found")
     it = CartItem.query.filter_by(cart_id=cart_id, article_id=article_id).first()
     if not it:
         abort(404, "Item not in cart")
     # release reservation
-    a = Article.query.get(article_id)
+    a = db.session.get(Article, article_id)
     if a:
         a.reserved = max(0, a.reserved - it.qty)
     db.session.delete(it)
-    db.session.commit()
     log_event("item_removed", {"cart_id": cart_id, "article_id": article_id}, actor=request.remote_addr)
+    db.session.commit()
     return jsonify({"message":"item_removed"})
 
-def compute_cart_totals(cart_id):
-    items = CartItem.query.filter_by(cart_id=cart_id).all()
-    total_ht = Decimal('0.00')
-    total_tax = Decimal('0.00')
-    for it in items:
-        line_net = (Decimal(it.unit_price) * it.qty) - Decimal(it.discount)
-        if line_net < 0:
-            line_net = Decimal('0.00')
-        vat = Decimal(it.article.vat) if it.article.vat is not None else TAX_RATE
-        tax = (line_net * vat)
-        total_ht += line_net
-        total_tax += tax
+def totals_from_units(ht_cents, tax_units):
+    total_ht = Decimal(ht_cents) / 100
+    total_tax = Decimal(tax_units) / 1000000
     return {
         "total_ht": decimal(total_ht),
         "total_tax": decimal(total_tax),
         "total_ttc": decimal(total_ht + total_tax)
     }
 
+def compute_totals_bulk(cart_ids):
+    # one grouped aggregate; amounts in cents and VAT in basis points keep the sums exact
+    price_cents = cast(func.round(CartItem.unit_price * 100), db.Integer)
+    discount_cents = cast(func.round(CartItem.discount * 100), db.Integer)
+    vat_bp = cast(func.round(func.coalesce(Article.vat, TAX_RATE) * 10000), db.Integer)
+    gross = price_cents * CartItem.qty - discount_cents
+    line_net = case((gross < 0, 0), else_=gross)
+    rows = db.session.query(
+        CartItem.cart_id,
+        func.sum(line_net),
+        func.sum(line_net * vat_bp)
+    ).select_from(CartItem).join(Article, CartItem.article_id == Article.id).filter(
+        CartItem.cart_id.in_(cart_ids)
+    ).group_by(CartItem.cart_id).all()
+    totals = {cart_id: totals_from_units(0, 0) for cart_id in cart_ids}
+    totals.update({cart_id: totals_from_units(ht, tax) for cart_id, ht, tax in rows})
+    return totals
+
+def compute_cart_totals(cart_id):
+    return compute_totals_bulk([cart_id])[cart_id]
+
 def simulate_payment_gateway(method, details, amount):
     try:
         amt = float(amount)
@@ -250,12 +334,14 @@ def checkout(cart_id):
     actor = data.get("actor", request.remote_addr)
     if not payment_method:
         abort(400, "payment_method required")
-    c = Cart.query.get(cart_id)
+    # reads, totals and the gateway call stay in a deferred transaction so the
+    # write lock is not held across a payment round-trip
+    c = db.session.get(Cart, cart_id)
     if not c:
         abort(404, "Cart not found")
     if c.status != 'OPEN':
         abort(400, "Cart not open")
-    items = CartItem.query.filter_by(cart_id=cart_id).all()
+    items = CartItem.query.options(selectinload(CartItem.article)).filter_by(cart_id=cart_id).all()
     if not items:
         abort(400, "Cart empty")
     # final stock check
@@ -264,57 +350,74 @@ def checkout(cart_id):
         if it.qty > a.stock:
             abort(400, f"Stock insuffisant pour article {a.id}")
     totals = compute_cart_totals(cart_id)
+    # stock changes go out as one executemany UPDATE rather than one per article
+    lines = [{'aid': it.article_id, 'qty': it.qty} for it in items]
+    release_stmt = update(Article).where(Article.id == bindparam('aid')).values(
+        reserved=case((Article.reserved > bindparam('qty'), Article.reserved - bindparam('qty')), else_=0))
     # simulate electronic payment
     if payment_method in ('card','mobile'):
         auth = simulate_payment_gateway(payment_method, payment_details, totals['total_ttc'])
         if not auth['authorized']:
             # release reservations
-            for it in items:
-                it.article.reserved = max(0, it.article.reserved - it.qty)
-            db.session.commit()
+            db.session.rollback()
+            begin_write()
+            db.session.connection().execute(release_stmt, lines)
             log_event('payment_failed', {'cart_id':cart_id, 'reason': auth.get('reason')}, actor=actor)
+            db.session.commit()
             return jsonify({'payment': 'FAILED', 'reason': auth.get('reason')}), 402
         payment_status = 'AUTHORIZED'
     else:
         payment_status = 'PENDING' if payment_method == 'cheque' else 'AUTHORIZED'
+    # end the read snapshot (nothing written yet) and take the write lock
+    db.session.rollback()
+    begin_write()
+    # a concurrent checkout may have closed the cart since it was read
+    claimed = db.session.execute(
+        update(Cart).where(Cart.id == cart_id, Cart.status == 'OPEN')
+        .values(status='PAID' if payment_status == 'AUTHORIZED' else 'CHECKOUT_PENDING')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        db.session.rollback()
+        abort(400, "Cart not open")
     # create invoice
     inv = Invoice(cart_id=cart_id, total_ht=totals['total_ht'], total_tax=totals['total_tax'], total_ttc=totals['total_ttc'], payment_method=payment_method, payment_status=payment_status)
     db.session.add(inv)
-    # decrement stock and clear reserved
-    for it in items:
-        a = it.article
-        a.reserved = max(0, a.reserved - it.qty)
-        a.stock = max(0, a.stock - it.qty)
-    c.status = 'PAID' if payment_status == 'AUTHORIZED' else 'CHECKOUT_PENDING'
-    db.session.commit()
+    # decrement stock and clear reserved; a line whose stock ran out meanwhile matches no row
+    consume_stmt = release_stmt.where(Article.stock >= bindparam('qty')).values(stock=Article.stock - bindparam('qty'))
+    if db.session.connection().execute(consume_stmt, lines).rowcount != len(lines):
+        db.session.rollback()
+        abort(400, "Stock insuffisant")
+    db.session.flush()
     log_event('checkout_success', {'cart_id': cart_id, 'invoice_id': inv.id, 'totals': totals}, actor=actor)
+    db.session.commit()
     # attempt to "sync" to ERP (simulated)
     # in real system you'd push to ERP and handle nack/ack
     return jsonify({'invoice_id': inv.id, 'totals': totals, 'payment_status': payment_status}), 201
 
 @app.route('/factures', methods=['GET'])
 def list_invoices():
-    invs = Invoice.query.order_by(Invoice.created_at.desc()).all()
-    out = []
-    for i in invs:
-        out.append({
-            "id": i.id,
-            "cart_id": i.cart_id,
-            "total_ht": float(i.total_ht),
-            "total_tax": float(i.total_tax),
-            "total_ttc": float(i.total_ttc),
-            "payment_method": i.payment_method,
-            "payment_status": i.payment_status,
-            "created_at": i.created_at.isoformat()
-        })
-    return jsonify({"invoices": out})
+    # keyset pagination: newest first, ?cursor=<id> returns invoices older than that id
+    cursor = request.args.get('cursor', type=int)
+    limit = max(1, min(request.args.get('limit', INVOICE_PAGE_SIZE, type=int), INVOICE_PAGE_SIZE))
+    # plain Row tuples: no ORM object hydration or identity-map bookkeeping
+    q = db.session.query(
+        Invoice.id, Invoice.cart_id, Invoice.total_ht, Invoice.total_tax, Invoice.total_ttc,
+        Invoice.payment_method, Invoice.payment_status, Invoice.created_at
+    )
+    if cursor:
+        q = q.filter(Invoice.id < cursor)
+    # the page is bounded, so read it in full and release the snapshot before sending
+    invs = q.order_by(Invoice.id.desc()).limit(limit).all()
+    next_cursor = invs[-1].id if len(invs) == limit else None
+    return ojsonify({"invoices": [row_invoice(i) for i in invs], "next_cursor": next_cursor})
 
 @app.route('/factures/<int:invoice_id>', methods=['GET'])
 def get_invoice(invoice_id):
-    i = Invoice.query.get(invoice_id)
+    i = db.session.get(Invoice, invoice_id)
     if not i:
         abort(404, "Invoice not found")
-    items = CartItem.query.filter_by(cart_id=i.cart_id).all()
+    items = CartItem.query.options(selectinload(CartItem.article)).filter_by(cart_id=i.cart_id).all()
     items_out = []
     for it in items:
         items_out.append({
@@ -324,16 +427,7 @@ def get_invoice(invoice_id):
             "unit_price": float(it.unit_price),
             "discount": float(it.discount)
         })
-    return jsonify({"invoice": {
-        "id": i.id,
-        "cart_id": i.cart_id,
-        "total_ht": float(i.total_ht),
-        "total_tax": float(i.total_tax),
-        "total_ttc": float(i.total_ttc),
-        "payment_method": i.payment_method,
-        "payment_status": i.payment_status,
-        "created_at": i.created_at.isoformat()
-    }, "items": items_out})
+    return ojsonify({"invoice": row_invoice(i), "items": items_out})
 
 # Admin reset (dev only)
 @app.route('/admin/reset-db', methods=['POST'])
@@ -350,5 +444,6 @@ if __name__ == '__main__':
     # ensure DB and seed inside application context to avoid context errors
     with app.app_context():
         db.create_all()
+        ensure_indexes()
         seed_defaults()
     app.run(host='127.0.0.1', port=5001, debug=True)